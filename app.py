@@ -1,15 +1,30 @@
-from flask import Flask, request, jsonify, render_template, Response
-import json
+from flask import Blueprint, Flask, request, jsonify, render_template, Response
+from flask_orjson import OrjsonProvider
 import logging
-from typing import Dict, Any, Optional
+from typing import Dict, Any, List, Optional, Set, Tuple
 from dotenv import load_dotenv
 import os
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, insert, inspect, select
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.exc import IntegrityError, OperationalError, TimeoutError as PoolTimeoutError
+import sqlite3
 import queue
 import threading
+import time
+import atexit
 import requests
-
-from mpesa import MPesaClient, normalize_phone_number
+import orjson
+import msgspec
+
+from mpesa import (
+    MPesaClient,
+    MPesaValidationError,
+    configure_logging,
+    normalize_phone_number,
+)
 
 # Load environment variables from .env file
 load_dotenv()
@@ -20,26 +35,99 @@ if not database_url:
     raise RuntimeError("DATABASE_URL not configured. Please check your .env file.")
 
 # Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    handlers=[logging.FileHandler("mpesa_callbacks.log"), logging.StreamHandler()],
-)
+configure_logging("mpesa_callbacks.log", os.getenv("LOG_LEVEL", "INFO").upper())
+
+# Werkzeug logs every request at INFO; keep only its warnings and errors
+logging.getLogger("werkzeug").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
 # Initialize Flask app
 app = Flask(__name__)
+# Use orjson for request parsing and jsonify() responses
+app.json = OrjsonProvider(app)
 app.config["SQLALCHEMY_DATABASE_URI"] = database_url
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-db = SQLAlchemy(app)
 
-# Global message queue for SSE
-message_queue = queue.Queue()
+# Keep a warm connection pool per worker; in-memory SQLite uses a
+# single-connection pool that doesn't accept sizing options
+engine_options = {"pool_pre_ping": True, "pool_recycle": 1800}
+db_url = make_url(database_url)
+if not (db_url.get_backend_name() == "sqlite" and db_url.database in (None, "", ":memory:")):
+    engine_options["pool_size"] = int(os.getenv("DB_POOL_SIZE", "20"))
+    engine_options["max_overflow"] = int(os.getenv("DB_MAX_OVERFLOW", "40"))
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options
+# Rows are written once and never read back, so skip post-commit reloads
+# and implicit flushes
+db = SQLAlchemy(app, session_options={"expire_on_commit": False, "autoflush": False})
+
+
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Use WAL on SQLite so status reads aren't blocked behind callback writes."""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.close()
+
+# One queue per connected SSE client; callbacks are fanned out to all of them.
+# The set is per process, so under several gunicorn workers a client only sees
+# callbacks handled by the worker serving its stream.
+_subscribers: Set["queue.Queue[Any]"] = set()
+_subscribers_lock = threading.Lock()
+
+# Each stream holds a worker thread, so streams end after SSE_MAX_DURATION
+# seconds (the browser reconnects after SSE_RETRY_MS) or when the worker stops
+SSE_MAX_DURATION = int(os.getenv("SSE_MAX_DURATION", "300"))
+SSE_RETRY_MS = 3000
+_STREAM_STOP = object()
+_shutting_down = threading.Event()
+
+
+def broadcast_transaction(transaction_details: Dict[str, Any]) -> None:
+    """Push transaction details to every connected SSE client."""
+    with _subscribers_lock:
+        subscribers = list(_subscribers)
+    for q in subscribers:
+        try:
+            q.put_nowait(transaction_details)
+        except queue.Full:
+            # Slow client; drop the event rather than block the callback
+            logger.warning("SSE subscriber queue full, dropping event")
+
+
+def stop_event_streams() -> None:
+    """End every open SSE stream so its thread is free for shutdown."""
+    _shutting_down.set()
+    with _subscribers_lock:
+        subscribers = list(_subscribers)
+    for q in subscribers:
+        try:
+            q.put_nowait(_STREAM_STOP)
+        except queue.Full:
+            pass  # The stream checks _shutting_down after its next event
+
+# Shared MPesa client so the OAuth token is reused across requests
+_mpesa_client: Optional[MPesaClient] = None
+_mpesa_client_lock = threading.Lock()
+
+
+def get_mpesa_client() -> MPesaClient:
+    """Return the process-wide MPesaClient, creating it on first use."""
+    global _mpesa_client
+    if _mpesa_client is None:
+        with _mpesa_client_lock:
+            if _mpesa_client is None:
+                _mpesa_client = MPesaClient()
+    return _mpesa_client
 
 # Define the Transaction model
 class Transaction(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    checkout_request_id = db.Column(db.String(100), nullable=True)
+    checkout_request_id = db.Column(db.String(100), nullable=True, unique=True, index=True)
     result_code = db.Column(db.Integer, nullable=False)
     result_desc = db.Column(db.String(255), nullable=False)
     amount = db.Column(db.Float, nullable=True)
@@ -47,66 +135,134 @@ class Transaction(db.Model):
     transaction_date = db.Column(db.String(20), nullable=True)
     phone_number = db.Column(db.String(15), nullable=True)
 
-def verify_recaptcha(recaptcha_response: str) -> bool:
-    return True
-    # recaptcha_secret = os.getenv("RECAPTCHA_SECRET_KEY")
-    # if not recaptcha_secret:
-    #     logger.error("RECAPTCHA_SECRET_KEY not configured. Please check your .env file.")
-    #     return False
+# reCAPTCHA settings are read once; the session keeps the TLS connection to Google
+RECAPTCHA_VERIFY_URL = "https://www.google.com/recaptcha/api/siteverify"
+_recaptcha_secret = os.getenv("RECAPTCHA_SECRET_KEY")
+_recaptcha_session = requests.Session()
+
+# Accepted (token, phone number, amount) submissions, mapped to when their cache
+# entry lapses. Tokens live for about two minutes, so only an identical
+# double-submit inside that window is answered locally; reusing a token for
+# another payment goes to Google, which rejects it. Rejections are never cached.
+RECAPTCHA_TOKEN_TTL = 120
+_RECAPTCHA_CACHE_MAX = 4096
+_recaptcha_verified: Dict[Tuple[str, str, str], float] = {}
+_recaptcha_lock = threading.Lock()
+
+
+def _verify_recaptcha_cached(
+    recaptcha_response: str, phone_number: str, amount: Any
+) -> bool:
+    key = (recaptcha_response, phone_number, str(amount))
+    now = time.monotonic()
+    with _recaptcha_lock:
+        if _recaptcha_verified.get(key, 0) > now:
+            return True
+
+    payload = {"secret": _recaptcha_secret, "response": recaptcha_response}
+    response = _recaptcha_session.post(RECAPTCHA_VERIFY_URL, data=payload, timeout=(2, 5))
+    response.raise_for_status()
+    success = bool(response.json().get("success", False))
+
+    if success:
+        with _recaptcha_lock:
+            if len(_recaptcha_verified) >= _RECAPTCHA_CACHE_MAX:
+                # Drop lapsed entries, or everything if they are all still live
+                for cached, expires_at in list(_recaptcha_verified.items()):
+                    if expires_at <= now:
+                        del _recaptcha_verified[cached]
+                if len(_recaptcha_verified) >= _RECAPTCHA_CACHE_MAX:
+                    _recaptcha_verified.clear()
+            _recaptcha_verified[key] = now + RECAPTCHA_TOKEN_TTL
+    return success
+
+
+def verify_recaptcha(recaptcha_response: str, phone_number: str, amount: Any) -> bool:
+    if not _recaptcha_secret:
+        logger.error("RECAPTCHA_SECRET_KEY not configured. Please check your .env file.")
+        return False
+    if not recaptcha_response:
+        return False
+
+    try:
+        return _verify_recaptcha_cached(recaptcha_response, phone_number, amount)
+    except requests.RequestException as e:
+        logger.error("reCAPTCHA verification failed: %s", e)
+        return False
+
+# Typed schema for the STK push callback; fields not listed here are ignored
+class StkCallbackItem(msgspec.Struct):
+    Name: str
+    Value: Any = None
+
+
+class StkCallbackMetadata(msgspec.Struct):
+    Item: List[StkCallbackItem] = []
+
 
-    # payload = {
-    #     'secret': recaptcha_secret,
-    #     'response': recaptcha_response
-    # }
-    # response = requests.post("https://www.google.com/recaptcha/api/siteverify", data=payload)
-    # result = response.json()
+class StkCallback(msgspec.Struct):
+    CheckoutRequestID: str
+    ResultCode: int
+    ResultDesc: str
+    CallbackMetadata: Optional[StkCallbackMetadata] = None
 
-    # return result.get("success", False)
+
+class StkCallbackBody(msgspec.Struct):
+    stkCallback: StkCallback
+
+
+class StkCallbackEnvelope(msgspec.Struct):
+    Body: StkCallbackBody
+
+
+# Lax mode accepts numbers sent as strings, e.g. "ResultCode": "0"
+_callback_decoder = msgspec.json.Decoder(StkCallbackEnvelope, strict=False)
+
+# Callback metadata item names mapped to transaction_details keys
+_META_KEYS = {
+    "Amount": "amount",
+    "MpesaReceiptNumber": "mpesa_receipt_number",
+    "TransactionDate": "transaction_date",
+    "PhoneNumber": "phone_number",
+}
 
 # MPesa Callback Processor
 class MPesaCallback:
     @staticmethod
-    def process_callback(callback_data: Dict[str, Any]) -> Dict[str, Any]:
-        try:
-            body = callback_data.get("Body", {})
-            stkCallback = body.get("stkCallback", {})
-
-            # Extract transaction details
-            checkout_request_id = stkCallback.get("CheckoutRequestID")
-            result_code = stkCallback.get("ResultCode")
-            result_desc = stkCallback.get("ResultDesc")
-
-            transaction_details = {
-                "checkout_request_id": checkout_request_id,
-                "result_code": result_code,
-                "result_desc": result_desc,
-                "amount": None,
-                "mpesa_receipt_number": None,
-                "transaction_date": None,
-                "phone_number": None,
-            }
-
-            # If successful, process metadata
-            if result_code == 0:
-                metadata_items = stkCallback.get("CallbackMetadata", {}).get("Item", [])
-                for item in metadata_items:
-                    name = item.get("Name")
-                    value = item.get("Value")
-                    if name == "Amount":
-                        transaction_details["amount"] = value
-                    elif name == "MpesaReceiptNumber":
-                        transaction_details["mpesa_receipt_number"] = value
-                    elif name == "TransactionDate":
-                        transaction_details["transaction_date"] = value
-                    elif name == "PhoneNumber":
-                        transaction_details["phone_number"] = value
-
-            logger.info(f"Processed callback: {transaction_details}")
-            return transaction_details
+    def process_callback(raw: bytes) -> Dict[str, Any]:
+        """
+        Decode and validate a raw callback body into transaction details.
 
-        except Exception as e:
-            logger.error(f"Error processing callback: {e}")
-            raise ValueError("Invalid callback data structure.")
+        Raises:
+            ValueError: If the body is not a valid STK push callback
+        """
+        try:
+            stkCallback = _callback_decoder.decode(raw).Body.stkCallback
+        except msgspec.MsgspecError as e:
+            raise ValueError(f"Invalid callback data structure: {e}") from e
+
+        # Extract transaction details
+        transaction_details = {
+            "checkout_request_id": stkCallback.CheckoutRequestID,
+            "result_code": stkCallback.ResultCode,
+            "result_desc": stkCallback.ResultDesc,
+            "amount": None,
+            "mpesa_receipt_number": None,
+            "transaction_date": None,
+            "phone_number": None,
+        }
+
+        # If successful, process metadata
+        metadata = stkCallback.CallbackMetadata
+        if stkCallback.ResultCode == 0 and metadata is not None:
+            meta_keys = _META_KEYS
+            for item in metadata.Item:
+                key = meta_keys.get(item.Name)
+                if key is not None:
+                    transaction_details[key] = item.Value
+
+        logger.info("Processed callback: %s", transaction_details)
+        return transaction_details
 
 @app.route("/")
 def index():
@@ -127,11 +283,11 @@ def initiate_payment():
         # Normalize phone number
         try:
             phone_number = normalize_phone_number(phone_number)
-        except ValueError as e:
+        except MPesaValidationError as e:
             return jsonify({"error": str(e)}), 400
 
         # Validate reCAPTCHA
-        # if not verify_recaptcha(recaptcha_response):
+        # if not verify_recaptcha(recaptcha_response, phone_number, amount):
         #     return jsonify({"error": "Invalid reCAPTCHA. Please try again."}), 400
 
         # Convert amount to float
@@ -140,14 +296,16 @@ def initiate_payment():
         except ValueError:
             return jsonify({"error": "Invalid amount format"}), 400
 
-        # Initialize MPesa client
-        mpesa_client = MPesaClient()
+        mpesa_client = get_mpesa_client()
         checkout_request_id = mpesa_client.send_stk_push(phone_number, amount)
 
         return jsonify({"checkout_request_id": checkout_request_id}), 200
 
+    except MPesaValidationError as e:
+        # Invalid phone number or amount rejected by the client
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
-        logger.error(f"Error initiating payment: {e}")
+        logger.error("Error initiating payment: %s", e)
         return jsonify({"error": str(e)}), 500
 
 @app.route("/check_status", methods=["POST"])
@@ -159,82 +317,339 @@ def check_status():
         if not checkout_request_id:
             return jsonify({"error": "Checkout request ID is required"}), 400
 
-        # Initialize MPesa client
-        mpesa_client = MPesaClient()
+        mpesa_client = get_mpesa_client()
         status = mpesa_client.query_transaction_status(checkout_request_id)
 
         return jsonify(status), 200
 
     except Exception as e:
-        logger.error(f"Error checking status: {e}")
+        logger.error("Error checking status: %s", e)
         return jsonify({"error": str(e)}), 500
 
-@app.route("/mpesa/callback", methods=["POST"])
+# Safaricom-facing routes
+mpesa_bp = Blueprint("mpesa", __name__)
+
+# The callback replies are constant, so encode them once
+_ACK_ACCEPTED = orjson.dumps({"ResultCode": 0, "ResultDesc": "Accepted"})
+_ACK_BUSY = orjson.dumps({"ResultCode": 1, "ResultDesc": "Server busy, retry later"})
+
+
+@mpesa_bp.route("/mpesa/callback", methods=["POST"])
 def mpesa_callback():
+    # Acknowledge immediately; parsing, storage and SSE run on a worker thread
+    _ensure_workers_started()
+    try:
+        _callback_q.put_nowait(request.get_data(cache=False))
+    except queue.Full:
+        logger.error("Callback queue is full, asking Safaricom to retry")
+        return app.response_class(_ACK_BUSY, status=503, mimetype="application/json")
+
+    return app.response_class(_ACK_ACCEPTED, status=200, mimetype="application/json")
+
+
+app.register_blueprint(mpesa_bp)
+
+@app.route("/stream")
+def stream():
+    def event_stream():
+        q: "queue.Queue[Any]" = queue.Queue(maxsize=100)
+        with _subscribers_lock:
+            _subscribers.add(q)
+        deadline = time.monotonic() + SSE_MAX_DURATION
+        try:
+            yield f"retry: {SSE_RETRY_MS}\n\n"
+            while not _shutting_down.is_set():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                try:
+                    # Wait for a new message for this client
+                    transaction_details = q.get(timeout=min(15, remaining))
+                except queue.Empty:
+                    # Nothing new; send a keep-alive comment
+                    yield ": keep-alive\n\n"
+                    continue
+                if transaction_details is _STREAM_STOP:
+                    return
+                yield f"data: {orjson.dumps(transaction_details).decode()}\n\n"
+        except Exception as e:
+            logger.error("Error in event stream: %s", e)
+            yield f"event: error\ndata: {orjson.dumps({'error': str(e)}).decode()}\n\n"
+        finally:
+            with _subscribers_lock:
+                _subscribers.discard(q)
+
+    return Response(
+        event_stream(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# Background workers: raw callbacks are processed on one thread and the
+# resulting rows are batched into the database on another
+_callback_q: "queue.Queue[Any]" = queue.Queue(maxsize=10000)
+_write_q: "queue.Queue[Any]" = queue.Queue(maxsize=10000)
+_WRITE_BATCH_SIZE = 500
+_WRITE_FLUSH_INTERVAL = 0.25  # seconds
+# Callbacks are acknowledged before they are stored, so rows are never dropped
+# for a database outage: lost connections, locks and pool timeouts are retried
+# with backoff while the queues fill up behind the writer
+_TRANSIENT_DB_ERRORS = (OperationalError, PoolTimeoutError)
+_WRITE_RETRY_DELAY = 0.5  # seconds
+_WRITE_RETRY_MAX_DELAY = 30.0
+_WORKER_STOP = object()
+_callback_thread: Optional[threading.Thread] = None
+_writer_thread: Optional[threading.Thread] = None
+_workers_lock = threading.Lock()
+
+
+def handle_callback(raw: bytes) -> None:
+    """Parse a raw callback body, then store and broadcast its transaction."""
     try:
-        callback_data = request.get_json()
-        logger.info(f"Received callback: {json.dumps(callback_data, indent=2)}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Received callback: %s", raw.decode("utf-8", "replace"))
+
+        # Decode, validate and extract transaction details
+        transaction_details = MPesaCallback.process_callback(raw)
 
-        # Process the callback to extract transaction details
-        transaction_details = MPesaCallback.process_callback(callback_data)
-        
         # Log processed transaction details
-        logger.info(f"Processed callback for CheckoutRequestID: {transaction_details['checkout_request_id']}")
-        logger.info(f"Processed transaction details: {json.dumps(transaction_details, indent=2)}")
+        logger.info(
+            "Processed callback for CheckoutRequestID: %s",
+            transaction_details["checkout_request_id"],
+        )
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "Processed transaction details: %s",
+                orjson.dumps(transaction_details).decode(),
+            )
 
         # Store the transaction in the database
         store_transaction_details(transaction_details)
 
         # Broadcast the transaction details to all connected clients
-        message_queue.put(transaction_details)
-
-        # Return transaction details as response
-        return jsonify({
-            "ResultCode": 0,
-            "ResultDesc": "Callback processed successfully",
-            "transaction_details": transaction_details
-        }), 200
+        broadcast_transaction(transaction_details)
     except Exception as e:
-        logger.error(f"Callback processing failed: {e}")
-        return jsonify({"ResultCode": 1, "ResultDesc": str(e)}), 500
+        # Safaricom already has its 200 and won't resend; keep the body recoverable
+        logger.error(
+            "Callback processing failed: %s; body: %s",
+            e,
+            raw.decode("utf-8", "replace"),
+        )
 
-@app.route("/stream")
-def stream():
-    def event_stream():
+
+def _callback_worker() -> None:
+    while True:
+        raw = _callback_q.get()
+        if raw is _WORKER_STOP:
+            return
+        handle_callback(raw)
+
+
+def _new_rows(batch: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    # Safaricom may deliver a callback more than once; keep the first copy only.
+    # This only sees this worker's rows; the insert itself ignores conflicts
+    # with rows another worker stored meanwhile.
+    ids = {row["checkout_request_id"] for row in batch if row["checkout_request_id"]}
+    seen = set()
+    if ids:
+        seen.update(
+            db.session.scalars(
+                select(Transaction.checkout_request_id).where(
+                    Transaction.checkout_request_id.in_(ids)
+                )
+            )
+        )
+
+    rows = []
+    for row in batch:
+        checkout_request_id = row["checkout_request_id"]
+        if checkout_request_id:
+            if checkout_request_id in seen:
+                logger.info("Skipping duplicate callback: %s", checkout_request_id)
+                continue
+            seen.add(checkout_request_id)
+        rows.append(row)
+    return rows
+
+
+# Dialects whose insert supports ON CONFLICT DO NOTHING
+_UPSERT_INSERTS = {"sqlite": sqlite_insert, "postgresql": postgresql_insert}
+
+
+def _transaction_insert():
+    dialect_insert = _UPSERT_INSERTS.get(db.engine.dialect.name)
+    if dialect_insert is None:
+        return insert(Transaction)  # Falls back to the unique constraint alone
+    return dialect_insert(Transaction).on_conflict_do_nothing(
+        index_elements=["checkout_request_id"]
+    )
+
+
+def _insert_transactions(batch: List[Dict[str, Any]]) -> None:
+    # Transient errors propagate to the caller; rows the database rejects are dropped
+    with app.app_context():
         try:
-            while True:
-                # Wait for a new message in the queue
-                transaction_details = message_queue.get(timeout=10)
-                yield f"data: {json.dumps(transaction_details)}\n\n"
-        except queue.Empty:
-            # If the queue is empty, send a keep-alive comment
-            yield ": keep-alive\n\n"
+            batch = _new_rows(batch)
+            if not batch:
+                return
+            db.session.execute(_transaction_insert(), batch)
+            db.session.commit()
+            logger.info("Stored %s transaction(s)", len(batch))
+            return
+        except _TRANSIENT_DB_ERRORS:
+            db.session.rollback()
+            raise
         except Exception as e:
-            logger.error(f"Error in event stream: {e}")
-            yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n"
+            db.session.rollback()
+            logger.error("Batch insert failed, retrying rows individually: %s", e)
+
+        # Isolate the bad rows so one malformed callback doesn't drop the batch
+        for row in batch:
+            try:
+                db.session.execute(_transaction_insert(), [row])
+                db.session.commit()
+            except _TRANSIENT_DB_ERRORS:
+                db.session.rollback()
+                raise
+            except Exception as e:
+                db.session.rollback()
+                logger.error(
+                    "Discarding invalid transaction %s: %s",
+                    row.get("checkout_request_id"),
+                    e,
+                )
+
+
+def _flush_transactions(batch: List[Dict[str, Any]]) -> None:
+    # Retries are safe: rows already committed are skipped as duplicates
+    delay = _WRITE_RETRY_DELAY
+    while True:
+        try:
+            _insert_transactions(batch)
+            return
+        except _TRANSIENT_DB_ERRORS as e:
+            logger.warning(
+                "Database unavailable, retrying %s transaction(s) in %.1fs: %s",
+                len(batch),
+                delay,
+                e,
+            )
+            time.sleep(delay)
+            delay = min(_WRITE_RETRY_MAX_DELAY, delay * 2)
+
+
+def _transaction_writer() -> None:
+    while True:
+        item = _write_q.get()
+        if item is _WORKER_STOP:
+            return
+
+        batch = [item]
+        stop = False
+        deadline = time.monotonic() + _WRITE_FLUSH_INTERVAL
+        while len(batch) < _WRITE_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = _write_q.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is _WORKER_STOP:
+                stop = True
+                break
+            batch.append(item)
+
+        _flush_transactions(batch)
+        if stop:
+            return
+
+
+def _stop_background_workers() -> None:
+    """Drain queued callbacks, then flush pending rows, on shutdown."""
+    stop_event_streams()
+    for q, thread in ((_callback_q, _callback_thread), (_write_q, _writer_thread)):
+        if thread is not None and thread.is_alive():
+            try:
+                q.put(_WORKER_STOP, timeout=5)
+            except queue.Full:
+                logger.error("Background worker %s is stuck, not waiting for it", thread.name)
+                continue
+            thread.join(timeout=10)
+
+
+def _ensure_workers_started() -> None:
+    global _callback_thread, _writer_thread
+    if _writer_thread is not None:
+        return
+    with _workers_lock:
+        if _writer_thread is None:
+            _callback_thread = threading.Thread(
+                target=_callback_worker, name="callback-worker", daemon=True
+            )
+            _callback_thread.start()
+            _writer_thread = threading.Thread(
+                target=_transaction_writer, name="transaction-writer", daemon=True
+            )
+            _writer_thread.start()
+            atexit.register(_stop_background_workers)
 
-    return Response(event_stream(), mimetype="text/event-stream")
 
 def store_transaction_details(transaction_details: Dict[str, Any]) -> None:
-    try:
-        transaction = Transaction(
-            checkout_request_id=transaction_details["checkout_request_id"],
-            result_code=transaction_details["result_code"],
-            result_desc=transaction_details["result_desc"],
-            amount=transaction_details.get("amount"),
-            mpesa_receipt_number=transaction_details.get("mpesa_receipt_number"),
-            transaction_date=transaction_details.get("transaction_date"),
-            phone_number=transaction_details.get("phone_number"),
-        )
-        db.session.add(transaction)
-        db.session.commit()
-        logger.info(f"Stored transaction: {transaction_details['checkout_request_id']}")
-    except Exception as e:
-        db.session.rollback()
-        logger.error(f"Failed to store transaction: {e}")
-        raise e
+    """
+    Queue a processed callback for the background writer.
+
+    Blocks while the writer is backed up, so the callback queue fills and
+    the callback endpoint answers 503 until the database catches up.
+    """
+    _ensure_workers_started()
+    _write_q.put(
+        {
+            "checkout_request_id": transaction_details["checkout_request_id"],
+            "result_code": transaction_details["result_code"],
+            "result_desc": transaction_details["result_desc"],
+            "amount": transaction_details.get("amount"),
+            "mpesa_receipt_number": transaction_details.get("mpesa_receipt_number"),
+            "transaction_date": transaction_details.get("transaction_date"),
+            "phone_number": transaction_details.get("phone_number"),
+        }
+    )
+    logger.info(
+        "Queued transaction: %s", transaction_details["checkout_request_id"]
+    )
+
+def init_db() -> None:
+    """Create the tables on a fresh database, or upgrade the checkout index."""
+    with app.app_context():
+        inspector = inspect(db.engine)
+        if not inspector.has_table(Transaction.__tablename__):
+            db.create_all()
+            return
+
+        # Databases created before checkout_request_id was unique have a plain
+        # index under the same name; the ON CONFLICT inserts need it unique
+        for index in Transaction.__table__.indexes:
+            existing = next(
+                (ix for ix in inspector.get_indexes(Transaction.__tablename__)
+                 if ix["name"] == index.name),
+                None,
+            )
+            if existing is None or existing["unique"]:
+                continue
+            logger.info("Upgrading %s to a unique index", index.name)
+            try:
+                with db.engine.begin() as conn:
+                    index.drop(conn)
+                    index.create(conn)
+            except IntegrityError:
+                logger.error(
+                    "Duplicate checkout_request_id rows block the unique index; "
+                    "remove them and restart"
+                )
+                raise
+
 
 if __name__ == "__main__":
-    with app.app_context():
-        db.create_all()
+    # Development server only; production runs gunicorn against wsgi.py
+    init_db()
     app.run(port=5000, debug=True)
\ No newline at end of file
@@ -0,0 +1,30 @@
+import multiprocessing
+import os
+import signal
+
+# Threaded workers: the app is I/O bound on Daraja calls and the SSE stream
+bind = os.getenv("BIND", "0.0.0.0:5000")
+worker_class = "gthread"
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+threads = int(os.getenv("GUNICORN_THREADS", "16"))
+keepalive = 5
+graceful_timeout = 30
+loglevel = os.getenv("LOG_LEVEL", "info").lower()
+
+
+def post_worker_init(worker):
+    # Open SSE streams would hold their threads until graceful_timeout; end
+    # them on SIGTERM before handing over to gunicorn's own handler
+    from app import stop_event_streams
+
+    def handle_term(sig, frame):
+        stop_event_streams()
+        worker.handle_exit(sig, frame)
+
+    signal.signal(signal.SIGTERM, handle_term)
+
+
+def worker_int(worker):
+    from app import stop_event_streams
+
+    stop_event_streams()
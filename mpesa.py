@@ -1,24 +1,104 @@
+import asyncio
+import atexit
 import base64
-import datetime
-import json
 import os
+import random
 import sys
+import threading
 import time
 import logging
-from typing import Dict, Optional
-from flask import jsonify
+import queue
+from logging.handlers import QueueHandler, QueueListener
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Union
+import httpx
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    handlers=[logging.FileHandler("mpesa_transactions.log"), logging.StreamHandler()],
-)
+_log_listener: Optional[QueueListener] = None
+
+
+def configure_logging(log_file: str, level: Union[int, str] = logging.INFO) -> None:
+    """
+    Send root logging to `log_file` and stderr through a background listener.
+
+    Records are formatted on the calling thread and written by the listener
+    thread, so callers never block on file I/O. Calling it again replaces
+    the previous configuration.
+    """
+    global _log_listener
+    _stop_log_listener()
+
+    log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(-1)
+    _log_listener = QueueListener(
+        log_queue, logging.FileHandler(log_file), logging.StreamHandler()
+    )
+    logging.basicConfig(
+        level=level,
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        handlers=[QueueHandler(log_queue)],
+        force=True,
+    )
+    _log_listener.start()
+
+
+def _stop_log_listener() -> None:
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        for handler in _log_listener.handlers:
+            handler.close()
+        _log_listener = None
+
+
+# Registered first, so it runs after every other exit hook that may log
+atexit.register(_stop_log_listener)
+
+# Handlers are left to the host program; main() and app.py call configure_logging
 logger = logging.getLogger(__name__)
 
+# (connect, read) timeout in seconds for every Daraja API call
+REQUEST_TIMEOUT = (3.05, 10)
+
+# Renew the OAuth token this many seconds before it expires, retrying
+# failed background refreshes after TOKEN_RETRY_INTERVAL
+TOKEN_REFRESH_MARGIN = 300
+TOKEN_RETRY_INTERVAL = 30
+
+# Connections kept per host; also the ceiling for concurrent batch requests
+POOL_MAXSIZE = 50
+
+# Exponential backoff bounds, in seconds
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0
+
+# STK result codes after which the status no longer changes: success,
+# insufficient funds, cancelled by user, unreachable, and prompt error
+TERMINAL_RESULT_CODES = frozenset({"0", "1", "1032", "1037", "1025"})
+
+# Status polling starts at POLL_INITIAL_DELAY seconds and grows by
+# POLL_BACKOFF_FACTOR per round, capped at RETRY_MAX_DELAY
+POLL_INITIAL_DELAY = 2.0
+POLL_BACKOFF_FACTOR = 1.5
+
+
+def _retry_delay(attempt: int, retry_after: Optional[str] = None) -> float:
+    """
+    Seconds to wait before retry number `attempt` (0-based).
+
+    Honors a numeric Retry-After hint up to RETRY_MAX_DELAY, otherwise uses
+    capped exponential backoff with jitter so concurrent clients don't retry
+    in lockstep.
+    """
+    if retry_after and retry_after.isdigit():
+        return min(RETRY_MAX_DELAY, float(retry_after))
+    return min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2**attempt) * random.uniform(0.5, 1.5)
+
 
 class MPesaError(Exception):
     """Custom exception for M-Pesa API related errors."""
@@ -26,7 +106,113 @@ class MPesaError(Exception):
     pass
 
 
-class MPesaClient:
+class MPesaValidationError(ValueError):
+    """Invalid caller input, such as a malformed phone number or amount."""
+
+    pass
+
+
+# Daraja answers status queries with HTTP 500 and this error code while the
+# customer has yet to enter their PIN; the API itself is healthy
+PENDING_ERROR_CODE = b"500.001.1001"
+
+
+def _is_pending(exc: BaseException) -> bool:
+    """True when Daraja reported the transaction as still being processed."""
+    if isinstance(exc, MPesaError):
+        exc = exc.__cause__
+    response = getattr(exc, "response", None)
+    return response is not None and PENDING_ERROR_CODE in response.content
+
+
+def _is_upstream_failure(exc: BaseException) -> bool:
+    """True for connection errors, timeouts and 5xx responses from Daraja."""
+    if isinstance(exc, MPesaError):
+        exc = exc.__cause__
+    if exc is None:
+        return False
+    response = getattr(exc, "response", None)
+    if response is not None:
+        return (
+            response.status_code >= 500
+            and PENDING_ERROR_CODE not in response.content
+        )
+    return isinstance(exc, (requests.RequestException, httpx.HTTPError))
+
+
+class CircuitBreaker:
+    """
+    Fail fast while the M-Pesa API is down.
+
+    After `failure_threshold` consecutive upstream failures the circuit opens
+    and calls made under ``with breaker:`` raise MPesaError without touching
+    the network. Once `reset_timeout` seconds pass, a single probe call is let
+    through; success closes the circuit, an upstream failure opens it again.
+    Any other exception is not counted either way.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def __enter__(self) -> "CircuitBreaker":
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    raise MPesaError("M-Pesa API circuit open, failing fast")
+                self.state = self.HALF_OPEN
+            elif self.state == self.HALF_OPEN:
+                # Another caller is already probing the API
+                raise MPesaError("M-Pesa API circuit open, failing fast")
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        if exc is None:
+            self.record_success()
+        elif _is_upstream_failure(exc):
+            self.record_failure()
+        else:
+            self._release_probe()
+        return False
+
+    def _release_probe(self) -> None:
+        # The call proved nothing about the API (cancelled, bad input, ...);
+        # keep opened_at so the next caller may probe straight away
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logger.warning(
+                        "M-Pesa API circuit opened after %s failure(s)", self.failures
+                    )
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+class BaseMPesaClient:
+    """
+    Configuration, payload building and response parsing shared by the
+    blocking and asyncio M-Pesa clients.
+    """
+
     def __init__(self):
         """
         Initialize MPesa client with environment configurations.
@@ -48,30 +234,201 @@ class MPesaClient:
             if not os.environ.get(env):
                 raise ValueError(f"Missing required environment variable: {env}")
 
-        self.base_url = os.environ.get("MPESA_BASE_API_URL")
+        self.base_url = os.environ.get("MPESA_BASE_API_URL").rstrip("/")
         self.short_code = os.environ.get("SHORTCODE")
         self.consumer_key = os.environ.get("CONSUMER_KEY")
         self.consumer_secret = os.environ.get("CONSUMER_SECRET")
         self.passkey = os.environ.get("PASSKEY")
         self.callback_url = os.environ.get("CALLBACK_URL")
+        self.trans_type = os.environ.get("TRANS_TYPE", "CustomerPayBillOnline")
+        self.party_b = os.environ.get("PARTY_B") or self.short_code
+
+        # Endpoint URLs, built once
+        self.token_url = f"{self.base_url}/oauth/v1/generate?grant_type=client_credentials"
+        self.stk_push_url = f"{self.base_url}/mpesa/stkpush/v1/processrequest"
+        self.query_url = f"{self.base_url}/mpesa/stkpushquery/v1/query"
+
+        # Payload fields that are the same on every request
+        self._stk_payload_template = {
+            "BusinessShortCode": self.short_code,
+            "TransactionType": self.trans_type,
+            "PartyB": self.party_b,
+            "CallBackURL": self.callback_url,
+        }
+        self._query_payload_template = {"BusinessShortCode": self.short_code}
+
+        # Short code and passkey are ASCII; encoded once for every password build
+        self._password_prefix = f"{self.short_code}{self.passkey}".encode("ascii")
 
         self.token = None
         self.token_expires_at = None
 
-    def _generate_password(self) -> str:
+        # Separate circuits, so a struggling query endpoint doesn't block STK pushes
+        self._stk_breaker = CircuitBreaker()
+        self._query_breaker = CircuitBreaker()
+
+    def _password_ts(self) -> Tuple[str, str]:
         """
         Generate base64 encoded password for API authentication.
 
         Returns:
-            str: Base64 encoded password
+            Tuple[str, str]: Base64 encoded password and the timestamp it was built from
         """
-        timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
-        password_string = f"{self.short_code}{self.passkey}{timestamp}"
-        return base64.b64encode(password_string.encode("utf-8")).decode("utf-8")
+        timestamp = time.strftime("%Y%m%d%H%M%S")
+        password = base64.b64encode(
+            self._password_prefix + timestamp.encode("ascii")
+        ).decode("ascii")
+        return password, timestamp
+
+    def _token_is_valid(self) -> bool:
+        # Treat the token as expired a minute early
+        return bool(
+            self.token
+            and self.token_expires_at
+            and time.monotonic() < self.token_expires_at - 60
+        )
+
+    def _store_token(self, token_data: Dict[str, Any]) -> str:
+        self.token = token_data.get("access_token")
+
+        # Daraja tokens are valid for about an hour
+        expires_in = int(token_data.get("expires_in", 3600))
+        self.token_expires_at = time.monotonic() + expires_in
+
+        logger.info("Successfully generated new M-Pesa API token")
+        return self.token
+
+    @staticmethod
+    def _validate_stk_push(phone_number: str, amount: int) -> str:
+        # Returns the phone number in 254XXXXXXXXX form; raises MPesaValidationError
+        phone_number = normalize_phone_number(phone_number)
+        if amount <= 0:
+            raise MPesaValidationError("Amount must be a positive number")
+        return phone_number
+
+    # Request bodies are encoded here once with orjson and sent as-is
+    def _stk_push_payload(
+        self, phone_number: str, amount: int, transaction_desc: str
+    ) -> bytes:
+        password, timestamp = self._password_ts()
+        return orjson.dumps({
+            **self._stk_payload_template,
+            "Password": password,
+            "Timestamp": timestamp,
+            "Amount": amount,
+            "PartyA": phone_number,
+            "PhoneNumber": phone_number,
+            "AccountReference": transaction_desc[:12],  # Truncate if too long
+            "TransactionDesc": transaction_desc,
+        })
+
+    def _query_payload(self, checkout_request_id: str) -> bytes:
+        password, timestamp = self._password_ts()
+        return orjson.dumps({
+            **self._query_payload_template,
+            "Password": password,
+            "Timestamp": timestamp,
+            "CheckoutRequestID": checkout_request_id,
+        })
+
+    @staticmethod
+    def _parse_stk_push_response(resp_data: Dict[str, Any]) -> str:
+        checkout_request_id = resp_data.get("CheckoutRequestID")
+
+        if not checkout_request_id:
+            raise MPesaError("No CheckoutRequestID received")
+
+        logger.info(
+            "STK Push initiated successfully. CheckoutRequestID: %s",
+            checkout_request_id,
+        )
+        return checkout_request_id
+
+    @staticmethod
+    def _parse_status_response(status_data: Dict[str, Any]) -> Dict[str, str]:
+        result_code = status_data.get("ResultCode")
+        result_desc = status_data.get("ResultDesc", "No description provided")
+
+        logger.info(
+            "Transaction query response: ResultCode=%s, ResultDesc=%s",
+            result_code,
+            result_desc,
+        )
+
+        return {
+            "result_code": result_code,
+            "result_desc": result_desc,
+            "status_message": status_data.get("statusMessage", "No message"),
+            "metadata": status_data.get("CallbackMetadata", {}),
+        }
+
+
+class MPesaClient(BaseMPesaClient):
+    def __init__(self, refresh_token_in_background: bool = True):
+        """
+        Initialize MPesa client with environment configurations.
+        Validates critical environment variables on instantiation.
+
+        Args:
+            refresh_token_in_background (bool, optional): Keep the OAuth token
+                fresh from a daemon thread instead of on the first request after expiry
+        """
+        super().__init__()
+        self._token_lock = threading.Lock()
+        self._stop_refresh = threading.Event()
+
+        # Keep-alive connection pool to Daraja; retries apply to idempotent GETs only
+        self.session = requests.Session()
+        self.session.mount(
+            "https://",
+            HTTPAdapter(
+                pool_connections=10,
+                pool_maxsize=POOL_MAXSIZE,
+                max_retries=Retry(
+                    total=2, backoff_factor=0.2, status_forcelist=[502, 503, 504]
+                ),
+            ),
+        )
+        # Status queries are read-only, so unlike STK pushes they are safe to
+        # retry; the longer mount prefix routes only that endpoint here
+        self.session.mount(
+            self.query_url,
+            HTTPAdapter(
+                pool_connections=10,
+                pool_maxsize=POOL_MAXSIZE,
+                max_retries=Retry(
+                    total=3,
+                    backoff_factor=RETRY_BASE_DELAY,
+                    backoff_max=RETRY_MAX_DELAY,
+                    backoff_jitter=RETRY_BASE_DELAY,
+                    # 500 is left out: Daraja's pending answer uses it, and
+                    # urllib3 can't tell the two apart without the body
+                    status_forcelist=(502, 503, 504),
+                    allowed_methods=frozenset(["POST"]),
+                    respect_retry_after_header=True,
+                    raise_on_status=False,
+                ),
+            ),
+        )
+        self.session.headers.update(
+            {"Accept": "application/json", "Content-Type": "application/json"}
+        )
+        self._basic_auth = HTTPBasicAuth(self.consumer_key, self.consumer_secret)
+
+        if refresh_token_in_background:
+            threading.Thread(
+                target=self._token_refresher, name="mpesa-token-refresher", daemon=True
+            ).start()
+
+    def close(self) -> None:
+        """Stop the token refresher and close pooled connections."""
+        self._stop_refresh.set()
+        self.session.close()
 
     def _get_mpesa_token(self) -> str:
         """
         Retrieve OAuth token, with smart caching to minimize unnecessary token requests.
+        Safe to call from multiple threads sharing one client.
 
         Returns:
             str: Valid access token
@@ -79,37 +436,47 @@ class MPesaClient:
         Raises:
             MPesaError: If token generation fails
         """
-        # Check if existing token is still valid
-        if (
-            self.token
-            and self.token_expires_at
-            and datetime.datetime.now() < self.token_expires_at
-        ):
+        # Fast path: a valid cached token needs no lock
+        if self._token_is_valid():
             return self.token
 
+        with self._token_lock:
+            # Another thread may have refreshed it while we waited
+            if self._token_is_valid():
+                return self.token
+            return self._fetch_token()
+
+    def _fetch_token(self) -> str:
+        # Callers must hold self._token_lock
         try:
-            url = f"{self.base_url}/oauth/v1/generate?grant_type=client_credentials"
-            response = requests.get(
-                url,
-                auth=HTTPBasicAuth(self.consumer_key, self.consumer_secret),
-                timeout=30,
+            response = self.session.get(
+                self.token_url,
+                auth=self._basic_auth,
+                timeout=REQUEST_TIMEOUT,
             )
             response.raise_for_status()
 
-            token_data = response.json()
-            self.token = token_data.get("access_token")
+            token_data = orjson.loads(response.content)
+            # Sent on every later Daraja call; the token GET overrides it with basic auth.
+            # Set before publishing the token so lock-free readers never run ahead of it.
+            self.session.headers["Authorization"] = f"Bearer {token_data.get('access_token')}"
+            return self._store_token(token_data)
 
-            # Set token expiration (usually 1 hour, add some buffer)
-            self.token_expires_at = datetime.datetime.now() + datetime.timedelta(
-                minutes=50
-            )
-
-            logger.info("Successfully generated new M-Pesa API token")
-            return self.token
+        except (requests.RequestException, orjson.JSONDecodeError) as e:
+            logger.error("Token generation failed: %s", e)
+            raise MPesaError(f"Failed to generate M-Pesa token: {e}") from e
 
-        except requests.RequestException as e:
-            logger.error(f"Token generation failed: {e}")
-            raise MPesaError(f"Failed to generate M-Pesa token: {e}")
+    def _token_refresher(self) -> None:
+        """Renew the token ahead of expiry so requests don't wait on OAuth."""
+        while not self._stop_refresh.is_set():
+            try:
+                with self._token_lock:
+                    self._fetch_token()
+                wait = self.token_expires_at - time.monotonic() - TOKEN_REFRESH_MARGIN
+            except MPesaError:
+                # Requests fall back to fetching the token themselves meanwhile
+                wait = TOKEN_RETRY_INTERVAL
+            self._stop_refresh.wait(max(1, wait))
 
     def send_stk_push(
         self,
@@ -129,60 +496,269 @@ class MPesaClient:
             str: Checkout request ID
 
         Raises:
-            MPesaError: For various API or validation errors
+            MPesaValidationError: If the phone number or amount is invalid
+            MPesaError: If the API call fails
         """
-        # Input validation
-        if not phone_number or not phone_number.startswith("254"):
+        phone_number = self._validate_stk_push(phone_number, amount)
+
+        with self._stk_breaker:
             try:
-                phone_number = normalize_phone_number(phone_number)
-            except ValueError as e:
-                return jsonify({"error": str(e)}), 400
-            
-        if amount <= 0:
-            raise ValueError("Amount must be a positive number")
+                self._get_mpesa_token()
 
-        try:
-            token = self._get_mpesa_token()
-            headers = {"Authorization": f"Bearer {token}"}
-
-            payload = {
-                "BusinessShortCode": self.short_code,
-                "Password": self._generate_password(),
-                "Timestamp": datetime.datetime.now().strftime("%Y%m%d%H%M%S"),
-                "TransactionType": os.environ.get(
-                    "TRANS_TYPE", "CustomerPayBillOnline"
+                payload = self._stk_push_payload(phone_number, amount, transaction_desc)
+
+                response = self.session.post(
+                    self.stk_push_url, data=payload, timeout=REQUEST_TIMEOUT
+                )
+                response.raise_for_status()
+
+                return self._parse_stk_push_response(orjson.loads(response.content))
+
+            except (requests.RequestException, orjson.JSONDecodeError) as e:
+                logger.error("STK Push request failed: %s", e)
+                raise MPesaError(f"STK Push request failed: {e}") from e
+
+    def query_transaction_status(self, checkout_request_id: str) -> Dict[str, str]:
+        """
+        Query transaction status with transport-level retries and structured response.
+
+        Args:
+            checkout_request_id (str): CheckoutRequestID received from STK Push.
+
+        Returns:
+            Dict[str, str]: Transaction status details.
+
+        Raises:
+            MPesaError: If the query fails after retries.
+        """
+        with self._query_breaker:
+            try:
+                self._get_mpesa_token()
+                payload = self._query_payload(checkout_request_id)
+
+                # 502-504 responses and connection errors are retried by the query adapter
+                response = self.session.post(
+                    self.query_url, data=payload, timeout=REQUEST_TIMEOUT
+                )
+                response.raise_for_status()
+
+                return self._parse_status_response(orjson.loads(response.content))
+
+            except (requests.RequestException, orjson.JSONDecodeError) as e:
+                logger.error("Transaction status query failed after retries: %s", e)
+                raise MPesaError(f"Persistent API error: {e}") from e
+
+    def wait_for_completion(
+        self, checkout_request_id: str, timeout: float = 180
+    ) -> Dict[str, str]:
+        """
+        Poll the transaction status until it reaches a terminal result code.
+
+        Polls back off from POLL_INITIAL_DELAY up to RETRY_MAX_DELAY with
+        jitter. Pending answers and upstream failures are retried until the
+        deadline; any other error, such as a 4xx or an open circuit, is raised
+        at once.
+
+        Args:
+            checkout_request_id (str): CheckoutRequestID received from STK Push.
+            timeout (float, optional): Seconds to keep polling
+
+        Returns:
+            Dict[str, str]: Final transaction status details.
+
+        Raises:
+            MPesaError: If no terminal status arrives within `timeout`.
+        """
+        deadline = time.monotonic() + timeout
+        delay = POLL_INITIAL_DELAY
+        last_error = None
+
+        while True:
+            try:
+                status = self.query_transaction_status(checkout_request_id)
+                if status["result_code"] in TERMINAL_RESULT_CODES:
+                    return status
+                logger.info("Transaction pending: %s", status["status_message"])
+            except MPesaError as e:
+                if not (_is_pending(e) or _is_upstream_failure(e)):
+                    raise
+                last_error = e
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise MPesaError(
+                    f"Transaction {checkout_request_id} not completed after {timeout}s"
+                ) from last_error
+            time.sleep(min(remaining, delay * random.uniform(0.8, 1.2)))
+            delay = min(RETRY_MAX_DELAY, delay * POLL_BACKOFF_FACTOR)
+
+    def _run_batch(
+        self, func: Callable[..., Any], calls: Iterable[Tuple], max_workers: int
+    ) -> List[Union[Any, Exception]]:
+        calls = list(calls)
+        if not calls:
+            return []
+
+        # The pool doesn't block, so threads beyond POOL_MAXSIZE would open extra
+        # connections that are thrown away after one request instead of reused
+        workers = max(1, min(max_workers, POOL_MAXSIZE, len(calls)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(func, *args) for args in calls]
+
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def send_stk_push_batch(
+        self, items: Iterable[Tuple[str, int, str]], max_workers: int = 10
+    ) -> List[Union[str, Exception]]:
+        """
+        Initiate several STK push transactions concurrently over the shared session.
+
+        Args:
+            items (Iterable[Tuple[str, int, str]]): (phone_number, amount, transaction_desc) tuples
+            max_workers (int, optional): Maximum concurrent requests
+
+        Returns:
+            List[Union[str, Exception]]: Checkout request ID for each item, in input
+                order, or the exception that item raised
+        """
+        return self._run_batch(self.send_stk_push, items, max_workers)
+
+    def query_transaction_status_batch(
+        self, checkout_request_ids: Iterable[str], max_workers: int = 10
+    ) -> List[Union[Dict[str, str], Exception]]:
+        """
+        Query the status of several transactions concurrently over the shared session.
+
+        Args:
+            checkout_request_ids (Iterable[str]): CheckoutRequestIDs received from STK Push
+            max_workers (int, optional): Maximum concurrent requests
+
+        Returns:
+            List[Union[Dict[str, str], Exception]]: Status details for each ID, in
+                input order, or the exception that query raised
+        """
+        return self._run_batch(
+            self.query_transaction_status,
+            ((checkout_request_id,) for checkout_request_id in checkout_request_ids),
+            max_workers,
+        )
+
+class AsyncMPesaClient(BaseMPesaClient):
+    """
+    asyncio counterpart of MPesaClient built on httpx.AsyncClient, so many
+    STK pushes or status queries can be awaited concurrently over one
+    keep-alive connection pool. Use it as an async context manager, or
+    call aclose() when done.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._token_lock = asyncio.Lock()
+
+        # The transport retries failed connects; 5xx handling is per endpoint below
+        self.client = httpx.AsyncClient(
+            headers={"Accept": "application/json", "Content-Type": "application/json"},
+            timeout=httpx.Timeout(REQUEST_TIMEOUT[1], connect=REQUEST_TIMEOUT[0]),
+            # Concurrent batch calls share one multiplexed connection when h2 is negotiated
+            transport=httpx.AsyncHTTPTransport(
+                http2=True,
+                retries=2,
+                limits=httpx.Limits(
+                    max_keepalive_connections=20, max_connections=POOL_MAXSIZE
                 ),
-                "Amount": amount,
-                "PartyA": phone_number,
-                "PartyB": os.environ.get("PARTY_B", self.short_code),
-                "PhoneNumber": phone_number,
-                "CallBackURL": self.callback_url,
-                "AccountReference": transaction_desc[:12],  # Truncate if too long
-                "TransactionDesc": transaction_desc,
-            }
-
-            url = f"{self.base_url}/mpesa/stkpush/v1/processrequest"
-            response = requests.post(url, json=payload, headers=headers, timeout=30)
-            response.raise_for_status()
+            ),
+        )
 
-            resp_data = response.json()
-            checkout_request_id = resp_data.get("CheckoutRequestID")
+    async def __aenter__(self) -> "AsyncMPesaClient":
+        return self
 
-            if not checkout_request_id:
-                raise MPesaError("No CheckoutRequestID received")
+    async def __aexit__(self, *exc_info) -> None:
+        await self.aclose()
 
-            logger.info(
-                f"STK Push initiated successfully. CheckoutRequestID: {checkout_request_id}"
-            )
-            return checkout_request_id
+    async def aclose(self) -> None:
+        """Close pooled connections held by the client."""
+        await self.client.aclose()
 
-        except requests.RequestException as e:
-            logger.error(f"STK Push request failed: {e}")
-            raise MPesaError(f"STK Push request failed: {e}")
+    async def _get_mpesa_token(self) -> str:
+        """
+        Retrieve OAuth token, reusing the cached one while it is valid.
 
-    def query_transaction_status(self, checkout_request_id: str) -> Dict[str, str]:
+        Returns:
+            str: Valid access token
+
+        Raises:
+            MPesaError: If token generation fails
+        """
+        if self._token_is_valid():
+            return self.token
+
+        async with self._token_lock:
+            if self._token_is_valid():
+                return self.token
+
+            try:
+                response = await self.client.get(
+                    self.token_url, auth=(self.consumer_key, self.consumer_secret)
+                )
+                response.raise_for_status()
+
+                logger.debug("Daraja negotiated %s", response.http_version)
+
+                token = self._store_token(orjson.loads(response.content))
+                self.client.headers["Authorization"] = f"Bearer {token}"
+                return token
+
+            except (httpx.HTTPError, orjson.JSONDecodeError) as e:
+                logger.error("Token generation failed: %s", e)
+                raise MPesaError(f"Failed to generate M-Pesa token: {e}") from e
+
+    async def send_stk_push(
+        self,
+        phone_number: str,
+        amount: int,
+        transaction_desc: str = "Payment Transaction",
+    ) -> str:
+        """
+        Initiate STK push transaction.
+
+        Args:
+            phone_number (str): Customer's phone number
+            amount (int): Transaction amount
+            transaction_desc (str, optional): Transaction description
+
+        Returns:
+            str: Checkout request ID
+
+        Raises:
+            MPesaValidationError: If the phone number or amount is invalid
+            MPesaError: If the API call fails
         """
-        Query transaction status with enhanced retry logic and structured response.
+        phone_number = self._validate_stk_push(phone_number, amount)
+
+        with self._stk_breaker:
+            try:
+                await self._get_mpesa_token()
+                payload = self._stk_push_payload(phone_number, amount, transaction_desc)
+
+                # Not retried: a repeated push would prompt the customer twice
+                response = await self.client.post(self.stk_push_url, content=payload)
+                response.raise_for_status()
+
+                return self._parse_stk_push_response(orjson.loads(response.content))
+
+            except (httpx.HTTPError, orjson.JSONDecodeError) as e:
+                logger.error("STK Push request failed: %s", e)
+                raise MPesaError(f"STK Push request failed: {e}") from e
+
+    async def query_transaction_status(self, checkout_request_id: str) -> Dict[str, str]:
+        """
+        Query transaction status, retrying server errors with backoff.
 
         Args:
             checkout_request_id (str): CheckoutRequestID received from STK Push.
@@ -194,78 +770,136 @@ class MPesaClient:
             MPesaError: If the query fails after retries.
         """
         max_retries = 3
-        retry_delay = 10  # seconds
 
-        for attempt in range(max_retries):
+        with self._query_breaker:
             try:
-                token = self._get_mpesa_token()
-                headers = {"Authorization": f"Bearer {token}"}
-                payload = {
-                    "BusinessShortCode": self.short_code,
-                    "Password": self._generate_password(),
-                    "Timestamp": datetime.datetime.now().strftime("%Y%m%d%H%M%S"),
-                    "CheckoutRequestID": checkout_request_id,
-                }
-                url = f"{self.base_url}/mpesa/stkpushquery/v1/query"
-
-                response = requests.post(url, json=payload, headers=headers, timeout=30)
-
-                if response.status_code == 500:
-                    logger.warning(
-                        f"Attempt {attempt + 1}: Server Error - Retrying in {retry_delay} seconds"
-                    )
-                    time.sleep(retry_delay)
-                    continue
+                await self._get_mpesa_token()
+                for attempt in range(max_retries):
+                    payload = self._query_payload(checkout_request_id)
+                    response = await self.client.post(self.query_url, content=payload)
+
+                    # A pending answer is final for this query; the poller asks again
+                    if (
+                        response.status_code >= 500
+                        and PENDING_ERROR_CODE not in response.content
+                        and attempt < max_retries - 1
+                    ):
+                        delay = _retry_delay(
+                            attempt, retry_after=response.headers.get("Retry-After")
+                        )
+                        logger.warning(
+                            "Attempt %s: Server Error - Retrying in %.1f seconds",
+                            attempt + 1,
+                            delay,
+                        )
+                        await asyncio.sleep(delay)
+                        continue
+
+                    response.raise_for_status()
+                    return self._parse_status_response(orjson.loads(response.content))
+
+            except (httpx.HTTPError, orjson.JSONDecodeError) as e:
+                logger.error("Transaction status query failed after retries: %s", e)
+                raise MPesaError(f"Persistent API error: {e}") from e
+
+    async def wait_for_completion(
+        self, checkout_request_id: str, timeout: float = 180
+    ) -> Dict[str, str]:
+        """
+        Poll the transaction status until it reaches a terminal result code.
+        See MPesaClient.wait_for_completion.
+        """
+        deadline = time.monotonic() + timeout
+        delay = POLL_INITIAL_DELAY
+        last_error = None
 
-                response.raise_for_status()
+        while True:
+            try:
+                status = await self.query_transaction_status(checkout_request_id)
+                if status["result_code"] in TERMINAL_RESULT_CODES:
+                    return status
+                logger.info("Transaction pending: %s", status["status_message"])
+            except MPesaError as e:
+                if not (_is_pending(e) or _is_upstream_failure(e)):
+                    raise
+                last_error = e
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise MPesaError(
+                    f"Transaction {checkout_request_id} not completed after {timeout}s"
+                ) from last_error
+            await asyncio.sleep(min(remaining, delay * random.uniform(0.8, 1.2)))
+            delay = min(RETRY_MAX_DELAY, delay * POLL_BACKOFF_FACTOR)
+
+    async def send_stk_push_batch(
+        self, items: Iterable[Tuple[str, int, str]]
+    ) -> List[Union[str, Exception]]:
+        """
+        Initiate several STK push transactions concurrently.
 
-                status_data = response.json()
-                result_code = status_data.get("ResultCode")
-                result_desc = status_data.get("ResultDesc", "No description provided")
+        Args:
+            items (Iterable[Tuple[str, int, str]]): (phone_number, amount, transaction_desc) tuples
 
-                logger.info(
-                    f"Transaction query response: ResultCode={result_code}, ResultDesc={result_desc}"
-                )
+        Returns:
+            List[Union[str, Exception]]: Checkout request ID for each item, in input
+                order, or the exception that item raised
+        """
+        return await asyncio.gather(
+            *(self.send_stk_push(*item) for item in items), return_exceptions=True
+        )
 
-                return {
-                    "result_code": result_code,
-                    "result_desc": result_desc,
-                    "status_message": status_data.get("statusMessage", "No message"),
-                    "metadata": status_data.get("CallbackMetadata", {}),
-                }
-
-            except requests.RequestException as e:
-                if attempt == max_retries - 1:
-                    logger.error(
-                        f"Transaction status query failed after {max_retries} attempts: {e}"
-                    )
-                    raise MPesaError(f"Persistent API error: {e}")
+    async def query_transaction_status_batch(
+        self, checkout_request_ids: Iterable[str]
+    ) -> List[Union[Dict[str, str], Exception]]:
+        """
+        Query the status of several transactions concurrently.
+
+        Args:
+            checkout_request_ids (Iterable[str]): CheckoutRequestIDs received from STK Push
+
+        Returns:
+            List[Union[Dict[str, str], Exception]]: Status details for each ID, in
+                input order, or the exception that query raised
+        """
+        return await asyncio.gather(
+            *(self.query_transaction_status(cid) for cid in checkout_request_ids),
+            return_exceptions=True,
+        )
+
+
+# Deletes every ASCII character except the digits
+_NON_DIGITS = str.maketrans("", "", "".join(chr(c) for c in range(128) if not chr(c).isdigit()))
 
-                logger.warning(f"Attempt {attempt + 1} failed: {e}")
-                time.sleep(retry_delay)
+# Accepted formats by digit count: (allowed prefixes, leading digits to drop)
+_MSISDN_FORMATS = {
+    12: (("2547", "2541"), 3),
+    10: (("07", "01"), 1),
+    9: (("7", "1"), 0),
+}
 
-        raise MPesaError("Unable to query transaction status after maximum retries")
 
 def normalize_phone_number(phone_number: str) -> str:
     """
     Normalize the phone number to start with 254.
-    Supports inputs like +254..., 07..., or 7...
+    Supports inputs like +254..., 07..., 01..., or 7...
     """
-    # Remove any non-digit characters (e.g., +, spaces)
-    phone_number = ''.join(filter(str.isdigit, phone_number))
+    digits = phone_number.translate(_NON_DIGITS)
+    fmt = _MSISDN_FORMATS.get(len(digits))
+    if fmt is not None and digits.isascii() and digits.isdigit() and digits.startswith(fmt[0]):
+        return "254" + digits[fmt[1]:]
+    raise MPesaValidationError(
+        "Invalid phone number format. Must start with +254, 07, 01, or 7."
+    )
 
-    # Check if the number starts with 254, 07, or 7
-    if phone_number.startswith('254'):
-        return phone_number  # Already in the correct format
-    elif phone_number.startswith('07') or phone_number.startswith('7'):
-        return '254' + phone_number.lstrip('07')  # Convert to 254 format
-    else:
-        raise ValueError("Invalid phone number format. Must start with +254, 07, or 7.")
 
 def main():
     """
     Main execution method with robust error handling and user feedback.
     """
+    configure_logging("mpesa_transactions.log")
+
+    mpesa_client = None
     try:
         mpesa_client = MPesaClient()
 
@@ -279,31 +913,23 @@ def main():
             phone_number=phone_number, amount=amount, transaction_desc=transaction_desc
         )
 
-        # Wait and check transaction status
-        max_retries = 5
-        retry_delay = 30  # seconds
-
-        for attempt in range(max_retries):
-            try:
-                status = mpesa_client.query_transaction_status(checkout_id)
-
-                if status["result_code"] == "0":  # Success
-                    logger.info(f"🎉 Transaction Successful: {status['result_desc']}")
-                    break
-                elif status["result_code"] in {"1", "1032"}:  # Common failures
-                    logger.warning(f"Transaction Failed: {status['result_desc']}")
-                    break
-                else:
-                    logger.info(f"Attempt {attempt + 1}: {status['status_message']}")
-                    time.sleep(retry_delay)
-
-            except MPesaError as e:
-                logger.error(f"Status check error: {e}")
-                break
+        # Poll until the customer completes, cancels or ignores the prompt
+        try:
+            status = mpesa_client.wait_for_completion(checkout_id)
+        except MPesaError as e:
+            logger.error("Status check error: %s", e)
+        else:
+            if status["result_code"] == "0":  # Success
+                logger.info("🎉 Transaction Successful: %s", status["result_desc"])
+            else:
+                logger.warning("Transaction Failed: %s", status["result_desc"])
 
     except Exception as e:
-        logger.critical(f"Unhandled error in M-Pesa transaction: {e}")
+        logger.critical("Unhandled error in M-Pesa transaction: %s", e)
         sys.exit(1)
+    finally:
+        if mpesa_client is not None:
+            mpesa_client.close()
 
 
 if __name__ == "__main__":